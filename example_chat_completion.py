@@ -4,6 +4,7 @@ chat completion creator
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 from pathlib import Path
@@ -13,13 +14,52 @@ import uuid
 
 import fire  # type: ignore
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    # fall back to stdlib json if orjson isn't around
+    orjson = None  # type: ignore
+
+try:
+    import fastjsonschema  # type: ignore
+except ImportError:
+    # fall back to the hand-rolled validation loop if it isn't around
+    fastjsonschema = None  # type: ignore
+
 from llama.generation import Llama, Dialog
 from llama.generation import PromptTooLongError
 from llama.logging import setup_logging
 
 
+# what a dialog file should look like - a non-empty list of dialogs, each a
+# list of messages with at least "role" and "content" keys
+DIALOGS_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "required": ["role", "content"],
+        },
+    },
+}
+
+# compile once at import time so validation is a single C-speed call
+_validate_dialogs = (
+    fastjsonschema.compile(DIALOGS_SCHEMA) if fastjsonschema is not None else None
+)
+
+
 def are_dialogs_valid(dialogs: Any, logger: logging.Logger) -> bool:
     """validates the thing works"""
+    if _validate_dialogs is not None:
+        try:
+            _validate_dialogs(dialogs)
+        except fastjsonschema.JsonSchemaException as error:
+            logger.error({"error": f"Dialog file failed validation: {error}"})
+            return False
+        return True
     if len(dialogs) == 0:
         logger.error(
             {"error": "Dialog file must be a list of dialogs, got an empty list"}
@@ -70,10 +110,15 @@ def load_dialogs(
 
     logger.info({"dialog_filename": dialog_filepath})
     try:
-        with dialog_filepath.open("r", encoding="utf-8") as fh:
-            dialogs = json.load(fh)
+        # read the raw bytes once and hand them to the fastest parser we have,
+        # instead of going through a text-mode file object and json.load
+        raw = dialog_filepath.read_bytes()
+        if orjson is not None:
+            dialogs = orjson.loads(raw)
+        else:
+            dialogs = json.loads(raw)
 
-    except json.JSONDecodeError as error:
+    except (json.JSONDecodeError, ValueError) as error:
         logger.error(
             {
                 "message": "failed to parse dialog file",
@@ -85,6 +130,18 @@ def load_dialogs(
     return dialogs
 
 
+def dialog_length_proxy(dialog: Dialog) -> int:
+    """cheap stand-in for the tokenized prompt length of a dialog"""
+    return sum(len(msg.get("content", "")) for msg in dialog)
+
+
+def dialog_system_prompt(dialog: Dialog) -> str:
+    """the system prompt for a dialog, or an empty string if there isn't one"""
+    if dialog and dialog[0].get("role", "") == "system":
+        return dialog[0].get("content", "")
+    return ""
+
+
 def main(
     ckpt_dir: str,
     tokenizer_path: str,
@@ -117,54 +174,83 @@ def main(
     execution_id = uuid.uuid4().hex
     random_seed = randint(0, 1000000)
 
-    dialogs = load_dialogs(dialog_filename, logger)
-    if not are_dialogs_valid(dialogs, logger):
-        return
-
-    generator = Llama.build(
-        ckpt_dir=ckpt_dir,
-        tokenizer_path=tokenizer_path,
-        max_seq_len=max_seq_len,
-        max_batch_size=max_batch_size,
-        logger=logger,
-        seed=random_seed,
-        execution_id=execution_id,
-    )
+    # load and prepare the dialog file in a worker thread while the (much
+    # slower) model load runs - the two don't depend on each other
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        dialogs_future = executor.submit(load_dialogs, dialog_filename, logger)
 
-    try:
-        results = generator.chat_completion(
-            dialogs,
-            max_gen_len=max_gen_len,
-            temperature=temperature,
-            top_p=top_p,
+        generator = Llama.build(
+            ckpt_dir=ckpt_dir,
+            tokenizer_path=tokenizer_path,
+            max_seq_len=max_seq_len,
+            max_batch_size=max_batch_size,
+            logger=logger,
+            seed=random_seed,
             execution_id=execution_id,
         )
-    except PromptTooLongError as error:
-        logger.error(
-            {
-                "message": "prompt too long",
-                "error": str(error),
-                "execution_id": execution_id,
-            }
-        )
+
+        dialogs = dialogs_future.result()
+
+    if not are_dialogs_valid(dialogs, logger):
         return
 
-    # roll up the input/output things
-    for dialog, result in zip(dialogs, results):
-        for dialog_idx, msg in enumerate(dialog):
-            gen_result = result.get("generation", {})
-            logger.info(
+    # sort by shared system prompt first, then by (roughly) prompt length -
+    # dialogs with the same system prompt land in the same batch so their
+    # common prefix is tokenized and prefilled together, and within a group
+    # the generator pads every sequence to the batch max, so mixing a tiny
+    # prompt in with a huge one just burns decode steps on padding
+    dialogs.sort(key=lambda dialog: (dialog_system_prompt(dialog), dialog_length_proxy(dialog)))
+
+    # run the dialogs through in max_batch_size-sized windows so the KV cache
+    # only ever has to hold one batch worth of sequences at a time
+    for batch_start in range(0, len(dialogs), max_batch_size):
+        batch = dialogs[batch_start : batch_start + max_batch_size]
+        try:
+            results = generator.chat_completion(
+                batch,
+                max_gen_len=max_gen_len,
+                temperature=temperature,
+                top_p=top_p,
+                execution_id=execution_id,
+            )
+        except PromptTooLongError as error:
+            logger.error(
                 {
-                    "action": "chat_content",
-                    "dialog_idx": dialog_idx,
-                    "request_role": msg.get("role"),
-                    "request": msg.get("content"),
-                    "dialog_id": msg.get("dialog_id", "<unknown id>"),
-                    "response_role": gen_result.get("role", "<unset role>"),
-                    "response": gen_result.get("content", "<no content was returned>"),
+                    "message": "prompt too long",
+                    "error": str(error),
                     "execution_id": execution_id,
                 }
             )
+            return
+
+        # roll up the input/output things into one record per batch rather
+        # than one logger call (and one formatter/handler pass) per message
+        chat_content = []
+        for dialog, result in zip(batch, results):
+            # pull the generation fields out once per result, not once per
+            # message - .get with a dict default built a throwaway dict and
+            # re-extracted the same fields for every message in the dialog
+            gen_result = result.get("generation") or {}
+            response_role = gen_result.get("role", "<unset role>")
+            response = gen_result.get("content", "<no content was returned>")
+            for dialog_idx, msg in enumerate(dialog):
+                chat_content.append(
+                    {
+                        "dialog_idx": dialog_idx,
+                        "request_role": msg.get("role"),
+                        "request": msg.get("content"),
+                        "dialog_id": msg.get("dialog_id", "<unknown id>"),
+                        "response_role": response_role,
+                        "response": response,
+                    }
+                )
+        logger.info(
+            {
+                "action": "chat_content",
+                "execution_id": execution_id,
+                "chat_content": chat_content,
+            }
+        )
 
 
 if __name__ == "__main__":
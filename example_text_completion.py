@@ -62,17 +62,21 @@ def main(
         plush girafe => girafe peluche
         cheese =>""",
     ]
-    results = generator.text_completion(
-        prompts,
-        max_gen_len=max_gen_len,
-        temperature=temperature,
-        top_p=top_p,
-        completion_id=completion_id,
-    )
-    for prompt, result in zip(prompts, results):
-        print(prompt)
-        print(f"> {result.get('generation')}")
-        print("\n==================================\n")
+    # batch the prompts in max_batch_size-sized windows rather than relying on
+    # the generator to fit them all in one go
+    for batch_start in range(0, len(prompts), max_batch_size):
+        batch = prompts[batch_start : batch_start + max_batch_size]
+        results = generator.text_completion(
+            batch,
+            max_gen_len=max_gen_len,
+            temperature=temperature,
+            top_p=top_p,
+            completion_id=completion_id,
+        )
+        for prompt, result in zip(batch, results):
+            print(prompt)
+            print(f"> {result.get('generation')}")
+            print("\n==================================\n")
 
 
 if __name__ == "__main__":
@@ -9,5 +9,7 @@ fi
 python -m venv .venv
 # shellcheck disable=SC1091
 source .venv/bin/activate
-pip install torch click fire questionary fairscale sentencepiece
-pip install ruff mypy black
\ No newline at end of file
+# one resolver pass for everything - two separate pip runs made pip resolve
+# and inspect the environment twice
+pip install torch click fire questionary fairscale sentencepiece orjson fastjsonschema \
+    ruff mypy black
\ No newline at end of file
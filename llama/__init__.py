@@ -3,7 +3,26 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+from typing import Any
 
-from .generation import Llama, Dialog  # noqa: F401
-from .model import ModelArgs, Transformer  # noqa: F401
-from .tokenizer import Tokenizer  # noqa: F401
+# lazy re-exports (PEP 562) - importing llama.generation/llama.model pulls in
+# torch and fairscale, which takes seconds; don't pay that until something
+# actually asks for one of these names
+_LAZY_IMPORTS = {
+    "Llama": "llama.generation",
+    "Dialog": "llama.generation",
+    "ModelArgs": "llama.model",
+    "Transformer": "llama.model",
+    "Tokenizer": "llama.tokenizer",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    """import the heavy submodules on first attribute access"""
+    if name in _LAZY_IMPORTS:
+        from importlib import import_module
+
+        return getattr(import_module(_LAZY_IMPORTS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -69,6 +69,10 @@ B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
 SPECIAL_TAGS = [B_INST, E_INST, "<<SYS>>", "<</SYS>>"]
 UNSAFE_ERROR = "Error: special tags are not allowed as part of the prompt."
 
+# how many decode steps to run between early-exit EOS checks - the check
+# forces a device-to-host sync, so don't pay for it every token
+EOS_CHECK_INTERVAL = 8
+
 
 class Llama:
     """Llama class"""
@@ -167,7 +171,15 @@ class Llama:
         ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {model_parallel_size}"
 
         ckpt_path = checkpoints[get_model_parallel_rank()]
-        checkpoint = torch.load(ckpt_path, map_location="cpu")
+        try:
+            # mmap avoids reading the whole checkpoint into anonymous memory
+            # up front, and weights_only skips the full unpickler
+            checkpoint = torch.load(
+                ckpt_path, map_location="cpu", mmap=True, weights_only=True
+            )
+        except TypeError:
+            # older torch without mmap / weights_only support
+            checkpoint = torch.load(ckpt_path, map_location="cpu")
         with open(
             Path(ckpt_dir) / "params.json", "r", encoding="utf-8"
         ) as checkpoint_file_handle:
@@ -210,6 +222,33 @@ class Llama:
 
         model = Transformer(model_args)
         model.load_state_dict(checkpoint, strict=False)
+
+        # CUDA already runs half precision via the default-tensor-type switch
+        # above; set LLAMA_QUANTIZE=1 to halve the weight footprint (and the
+        # memory bandwidth per decode step) on cpu/mps too, by casting the
+        # weights to bfloat16 at load time. torch's int8 dynamic quantizer
+        # only swaps out nn.Linear modules, which fairscale's parallel linear
+        # layers aren't, so this is as far down as we can go here
+        if device != "cuda" and os.environ.get("LLAMA_QUANTIZE"):
+            model = model.to(torch.bfloat16)
+            logger.info({"action": "cast model weights", "dtype": "bfloat16"})
+
+        # opt-in because fairscale's parallel layers don't always play nicely
+        # with the tracer - set LLAMA_COMPILE=1 to compile the forward pass,
+        # which fuses the per-step decode kernels after warmup
+        if os.environ.get("LLAMA_COMPILE"):
+            try:
+                model = torch.compile(model)  # type: ignore[assignment]
+                logger.info({"action": "torch.compile enabled"})
+            # pylint: disable=broad-except
+            except Exception as error:
+                logger.warning(
+                    {
+                        "message": "torch.compile failed, continuing uncompiled",
+                        "error": error,
+                    }
+                )
+
         logger.info(
             {
                 "action": "finished loading model",
@@ -303,21 +342,31 @@ class Llama:
         total_len = min(params.max_seq_len, max_gen_len + max_prompt_len)
 
         pad_id = self.tokenizer.pad_id
-        tokens = torch.full(
-            (bsz, total_len), pad_id, dtype=torch.long, device=self.device
+        # pad the rows out in Python and build the batch tensor in a single
+        # host-to-device copy, rather than a tiny torch.tensor allocation and
+        # slice-assign per prompt
+        tokens = torch.as_tensor(
+            [t + [pad_id] * (total_len - len(t)) for t in prompt_tokens],
+            dtype=torch.long,
+            device=self.device,
         )
-        for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device=self.device)
 
-        # store the token probabilities if we're going to log them
-        token_logprobs = (
-            torch.zeros_like(tokens, dtype=torch.float) if logprobs else None
-        )
+        # store the token probabilities if we're going to log them - no grid
+        # at all when logprobs is off, and none when the full-prompt special
+        # case below is about to replace it with its own tensor anyway
+        token_logprobs = None
+        if logprobs and min_prompt_len != total_len:
+            token_logprobs = torch.zeros(
+                (bsz, total_len), dtype=torch.float, device=self.device
+            )
 
         prev_pos = 0
         eos_reached = torch.tensor([False] * bsz, device=self.device)
         input_text_mask = tokens != pad_id
-        if min_prompt_len == total_len:
+        # if the shortest prompt already fills the sequence there's nothing to
+        # generate - the only reason to run the model at all is to score the
+        # prompt tokens, so skip the full forward pass unless asked for them
+        if min_prompt_len == total_len and logprobs:
             logits = self.model.forward(tokens, prev_pos)
             token_logprobs = -F.cross_entropy(
                 input=logits.transpose(1, 2),
@@ -326,57 +375,83 @@ class Llama:
                 ignore_index=pad_id,
             )
 
+        # make sure the model is on the device once, not every decode step -
+        # .to() on an already-placed model still walks every parameter
+        self.model.to(self.device)
+
+        # hoist the hot attribute lookups out of the per-token loop
+        model_forward = self.model.forward
+        eos_id = self.tokenizer.eos_id
+
         # iterate over the tokens in the prompt
         for cur_pos in range(min_prompt_len, total_len):
-            # send the model to the device to make sure it's up to date
-            self.model.to(self.device)
-
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+            logits = model_forward(tokens[:, prev_pos:cur_pos], prev_pos)
             if temperature > 0:
-                next_token = sample_top_p(
-                    torch.softmax(logits[:, -1] / temperature, dim=-1), top_p
-                )
+                if top_p >= 1.0:
+                    # no nucleus cutoff to apply, so sample straight off the
+                    # logits - no softmax, sort or multinomial needed
+                    next_token = sample_gumbel(logits[:, -1], temperature)
+                else:
+                    next_token = sample_top_p(
+                        torch.softmax(logits[:, -1] / temperature, dim=-1), top_p
+                    )
             else:
                 next_token = torch.argmax(logits[:, -1], dim=-1)
 
             next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
+            # only replace token if prompt has already been generated - once
+            # cur_pos is past the longest prompt the mask column is all False
+            # and the where() is a guaranteed no-op, so don't launch it
+            if cur_pos < max_prompt_len:
+                next_token = torch.where(
+                    input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+                )
             tokens[:, cur_pos] = next_token
             if logprobs and token_logprobs is not None:
-                token_logprobs[:, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
-                    input=logits.transpose(1, 2),
-                    target=tokens[:, prev_pos + 1 : cur_pos + 1],
-                    reduction="none",
-                    ignore_index=pad_id,
-                )
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (
-                next_token == self.tokenizer.eos_id
-            )
+                if cur_pos - prev_pos > 1:
+                    # prefill chunk - score the whole prompt slice in one go
+                    token_logprobs[:, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
+                        input=logits.transpose(1, 2),
+                        target=tokens[:, prev_pos + 1 : cur_pos + 1],
+                        reduction="none",
+                        ignore_index=pad_id,
+                    )
+                else:
+                    # steady-state decode step - a log_softmax and a gather on
+                    # the last position is much cheaper than cross_entropy
+                    # over a transposed single-column view
+                    token_logprobs[:, cur_pos] = (
+                        torch.log_softmax(logits[:, -1].float(), dim=-1)
+                        .gather(1, tokens[:, cur_pos : cur_pos + 1])
+                        .squeeze(1)
+                    )
+            eos_reached |= (~input_text_mask[:, cur_pos]) & (next_token == eos_id)
             prev_pos = cur_pos
-            if all(eos_reached):
+            # all(eos_reached) pulled the tensor back element by element every
+            # step; keep the reduction on-device and only sync every few steps.
+            # any tokens generated past EOS get trimmed off below anyway
+            if (cur_pos - min_prompt_len) % EOS_CHECK_INTERVAL == 0 and bool(
+                eos_reached.all()
+            ):
                 break
 
         if logprobs and token_logprobs is not None:
             token_logprobs = token_logprobs.tolist()  # type: ignore
         out_tokens, out_logprobs = [], []
 
+        logprob_rows = token_logprobs if logprobs and token_logprobs is not None else None
         for i, toks in enumerate(tokens.tolist()):
-            # cut to max gen len
-            start = 0 if echo else len(prompt_tokens[i])
-            toks = toks[start : len(prompt_tokens[i]) + max_gen_len]
-            probs = None
-            if logprobs and token_logprobs is not None:
-                probs = token_logprobs[i][start : len(prompt_tokens[i]) + max_gen_len]
-            # cut to eos tok if any
-            if self.tokenizer.eos_id in toks:
-                eos_idx = toks.index(self.tokenizer.eos_id)
-                toks = toks[:eos_idx]
-                if logprobs and token_logprobs is not None and probs is not None:
-                    probs = probs[:eos_idx] if logprobs else None
-            out_tokens.append(toks)
+            # work out the cut points once - echo/max-gen-len bounds, pulled
+            # in to the eos token if there is one - then slice tokens and
+            # logprobs with the same indices instead of re-slicing each list
+            prompt_len = len(prompt_tokens[i])
+            start = 0 if echo else prompt_len
+            end = prompt_len + max_gen_len
+            try:
+                end = toks.index(eos_id, start, end)
+            except ValueError:
+                pass
+            out_tokens.append(toks[start:end])
 
             # this is logging for each dialogue, not per-token
             # self.logger.info(
@@ -386,7 +461,9 @@ class Llama:
             #         "tokens": self.tokenizer.decode(out_tokens),
             #     }
             # )
-            out_logprobs.append(probs)
+            out_logprobs.append(
+                logprob_rows[i][start:end] if logprob_rows is not None else None
+            )
 
         log_result: Dict[str, Any] = {
             "action": "generate_end",
@@ -455,7 +532,8 @@ class Llama:
 
         if max_gen_len is None:
             max_gen_len = self.model.params.max_seq_len - 1
-        prompt_tokens = [self.tokenizer.encode(x, bos=True, eos=False) for x in prompts]
+        # one call into sentencepiece for the whole batch rather than one per prompt
+        prompt_tokens = self.tokenizer.encode_batch(prompts, bos=True, eos=False)
         generation_tokens, generation_logprobs = self.generate(
             completion_id=completion_id,
             prompt_tokens=prompt_tokens,
@@ -539,7 +617,11 @@ class Llama:
 
         if max_gen_len is None:
             max_gen_len = self.model.params.max_seq_len - 1
-        prompt_tokens = []
+
+        # first pass: assign ids and validate every dialog up front, so a bad
+        # dialog fails fast instead of after tokenizing everything before it,
+        # and the encoding loop below does nothing but tokenizer work
+        prepared_dialogs: List[Dialog] = []
         unsafe_requests = []
         for dialog in dialogs:
             dialog_id = uuid.uuid4().hex
@@ -551,6 +633,10 @@ class Llama:
                 )
             )
             if dialog[0].get("role", "") == "system":
+                # grab everything after the system+user pair off the original
+                # list before rebinding dialog - slicing the merged one-element
+                # list instead silently drops the rest of the conversation
+                rest = dialog[2:]
                 dialog = [
                     {
                         "dialog_id": dialog_id,
@@ -566,19 +652,21 @@ class Llama:
                             ]
                         ),
                     }
-                ]
-                # append the rest of the dialog onto the end of it
-                for dialog_sub in dialog[2::]:
-                    dialog_sub["dialog_id"] = dialog_id
-                    dialog.append(dialog_sub)
-            # validate the pattern of inputs
-            if not all(msg.get("role", "") == "user" for msg in dialog[::2]) and all(
-                msg.get("role", "") == "assistant" for msg in dialog[1::2]
+                ] + rest
+            # validate the pattern of inputs - both halves of the u/a/u/a
+            # pattern have to hold for the dialog to be valid
+            if not (
+                all(msg.get("role", "") == "user" for msg in dialog[::2])
+                and all(msg.get("role", "") == "assistant" for msg in dialog[1::2])
             ):
                 raise DialogOrderError(
                     "model only supports 'system', 'user' and 'assistant' roles, starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
                 )
 
+            assert (
+                dialog[-1].get("role", "") == "user"
+            ), f"Last message must be from user, got {dialog[-1].get('role', '')}"
+
             for dialog_sub in dialog:
                 dialog_sub["dialog_id"] = dialog_id
 
@@ -591,31 +679,41 @@ class Llama:
                 }
             )
 
-            # encode it as a list of ints so we can throw it into the model
-            dialog_tokens: List[int] = sum(
-                [
-                    self.tokenizer.encode(
-                        f"{B_INST} {(prompt.get('content', '')).strip()} {E_INST} {(answer.get('content','')).strip()} ",
-                        bos=True,
-                        eos=True,
-                    )
-                    for prompt, answer in zip(
-                        dialog[::2],
-                        dialog[1::2],
-                    )
-                ],
-                [],
+            prepared_dialogs.append(dialog)
+
+        # second pass: flatten every turn of every dialog into one string
+        # list, tokenize the lot in a single batch call, then stitch the
+        # results back into one token list per dialog - completed turns get an
+        # EOS appended, the trailing user turn doesn't
+        turn_strings: List[str] = []
+        turn_eos: List[bool] = []
+        turn_counts: List[int] = []
+        for dialog in prepared_dialogs:
+            turns = 0
+            for prompt, answer in zip(dialog[::2], dialog[1::2]):
+                turn_strings.append(
+                    f"{B_INST} {(prompt.get('content', '')).strip()} {E_INST} {(answer.get('content','')).strip()} "
+                )
+                turn_eos.append(True)
+                turns += 1
+            turn_strings.append(
+                f"{B_INST} {(dialog[-1].get('content', '')).strip()} {E_INST}"
             )
+            turn_eos.append(False)
+            turn_counts.append(turns + 1)
 
-            assert (
-                dialog[-1].get("role", "") == "user"
-            ), f"Last message must be from user, got {dialog[-1].get('role', '')}"
+        encoded_turns = self.tokenizer.encode_batch(turn_strings, bos=True, eos=False)
 
-            dialog_tokens += self.tokenizer.encode(
-                f"{B_INST} {(dialog[-1].get('content', '')).strip()} {E_INST}",
-                bos=True,
-                eos=False,
-            )
+        prompt_tokens = []
+        eos_id = self.tokenizer.eos_id
+        turn_idx = 0
+        for turns in turn_counts:
+            dialog_tokens: List[int] = []
+            for _ in range(turns):
+                dialog_tokens.extend(encoded_turns[turn_idx])
+                if turn_eos[turn_idx]:
+                    dialog_tokens.append(eos_id)
+                turn_idx += 1
             prompt_tokens.append(dialog_tokens)
 
         generation_tokens, generation_logprobs = self.generate(
@@ -669,6 +767,28 @@ class Llama:
         return result  # type: ignore
 
 
+def sample_gumbel(logits: torch.Tensor, temperature: float) -> torch.Tensor:
+    """
+    Sample from the temperature-scaled softmax distribution via the Gumbel-max trick.
+
+    Args:
+        logits (torch.Tensor): Raw logits for the next token.
+        temperature (float): Temperature value to scale the logits by.
+
+    Returns:
+        torch.Tensor: Sampled token indices.
+
+    Note:
+        argmax(logits / temperature + gumbel_noise) draws from exactly the same
+        distribution as softmax(logits / temperature) followed by multinomial,
+        without ever materialising the probabilities. Only valid when no top-p
+        cutoff is being applied.
+
+    """
+    gumbel = -torch.log(-torch.log(torch.rand_like(logits)))
+    return torch.argmax(logits / temperature + gumbel, dim=-1)
+
+
 def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
     """
     Perform top-p (nucleus) sampling on a probability distribution.
@@ -687,9 +807,9 @@ def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
     """
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
-    mask = probs_sum - probs_sort > p
-    probs_sort[mask] = 0.0
-    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    # zero out the tail with a where() instead of a boolean-mask scatter, and
+    # skip renormalising entirely - multinomial accepts unnormalised weights
+    probs_sort = torch.where(probs_sum - probs_sort > p, 0.0, probs_sort)
     next_token = torch.multinomial(probs_sort, num_samples=1)
     next_token = torch.gather(probs_idx, -1, next_token)
     return next_token
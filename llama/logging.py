@@ -1,21 +1,46 @@
 """ log handler things """
 
+import atexit
 from datetime import datetime
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 import sys
 from typing import Any, Dict
 
+# one encoder reused for every record - json.dumps with keyword options
+# builds and throws away a fresh JSONEncoder per call
+_ENCODER = json.JSONEncoder(default=str, sort_keys=True, ensure_ascii=False)
+
 
 class JSONFormatter(logging.Formatter):
     """formats things for logging purposes"""
 
+    def __init__(self) -> None:
+        super().__init__()
+        # consecutive records usually land within the same second, so cache
+        # the expensive datetime/isoformat work at one-second granularity
+        self._last_secs = -1
+        self._last_time = ""
+
+    def format_time(self, created: float) -> str:
+        """isoformat timestamp for a record's creation time, mostly cached"""
+        secs = int(created)
+        if secs != self._last_secs:
+            self._last_time = datetime.utcfromtimestamp(secs).isoformat()
+            self._last_secs = secs
+        return f"{self._last_time}.{int((created - secs) * 1_000_000):06d}"
+
     def format(self, record: logging.LogRecord) -> str:
         """format the message"""
         msg = record.msg
 
         if isinstance(msg, dict):
-            res: Dict[str, Any] = msg
+            # shallow-copy so injecting level/_time below doesn't mutate the
+            # caller's dict - it may still be live (and, with the queue
+            # listener, we're annotating it from another thread)
+            res: Dict[str, Any] = {**msg}
         else:
             if isinstance(msg, str):
                 try:
@@ -29,16 +54,35 @@ class JSONFormatter(logging.Formatter):
                 res = {"message": msg}
 
         res["level"] = record.levelname
-        res["_time"] = datetime.utcnow().isoformat()
-        return json.dumps(res, default=str, sort_keys=True, ensure_ascii=False)
+        res["_time"] = self.format_time(record.created)
+        return _ENCODER.encode(res)
+
+
+class DictQueueHandler(QueueHandler):
+    """queue handler that leaves dict payloads alone"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """the stock prepare() flattens record.msg to a string, which would
+        break JSONFormatter's dict handling - everything stays in-process
+        here, so ship the record through untouched"""
+        return record
 
 
 def setup_logging() -> logging.Logger:
     """sets up logging"""
     logger = logging.getLogger("llama")
-    handler = logging.FileHandler("llama_llm_logs.json")
-    handler.setFormatter(JSONFormatter())
-    logger.addHandler(handler)
-    logger.addHandler(logging.StreamHandler(sys.stdout))
+    file_handler = logging.FileHandler("llama_llm_logs.json")
+    file_handler.setFormatter(JSONFormatter())
+
+    # push records through a queue so formatting and file/stream writes
+    # happen on a background thread instead of the generate hot path
+    queue: "SimpleQueue[logging.LogRecord]" = SimpleQueue()
+    listener = QueueListener(
+        queue, file_handler, logging.StreamHandler(sys.stdout)
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(DictQueueHandler(queue))
     logger.setLevel(logging.INFO)
     return logger
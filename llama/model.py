@@ -244,27 +244,15 @@ class Attention(nn.Module):
             input_is_parallel=True,
             init_method=lambda x: x,
         )
-        if args.runtime == "nncl":
-            # print("Using CUDA for torch.zeros")
-            self.cache_k = torch.zeros(
-                (
-                    args.max_batch_size,
-                    args.max_seq_len,
-                    self.n_local_kv_heads,
-                    self.head_dim,
-                )
-            ).cuda()
-            self.cache_v = torch.zeros(
-                (
-                    args.max_batch_size,
-                    args.max_seq_len,
-                    self.n_local_kv_heads,
-                    self.head_dim,
-                )
-            ).cuda()
-        else:
-            # print(f"Using {args.device} for torch.zeros")
-            self.cache_k = torch.zeros(
+        # the KV cache lives on the target device for the lifetime of the
+        # module - allocate it there once and never move it again. registered
+        # as non-persistent buffers so Module.to(dtype) casts them alongside
+        # the weights (a plain attribute would stay float32 and blow up the
+        # attention matmuls after a low-precision cast) without them leaking
+        # into the state dict
+        self.register_buffer(
+            "cache_k",
+            torch.zeros(
                 (
                     args.max_batch_size,
                     args.max_seq_len,
@@ -272,8 +260,12 @@ class Attention(nn.Module):
                     self.head_dim,
                 ),
                 device=torch.device(args.device),
-            ).to(args.device)
-            self.cache_v = torch.zeros(
+            ),
+            persistent=False,
+        )
+        self.register_buffer(
+            "cache_v",
+            torch.zeros(
                 (
                     args.max_batch_size,
                     args.max_seq_len,
@@ -281,7 +273,9 @@ class Attention(nn.Module):
                     self.head_dim,
                 ),
                 device=torch.device(args.device),
-            ).to(args.device)
+            ),
+            persistent=False,
+        )
         self.args = args
 
     def forward(
@@ -318,12 +312,6 @@ class Attention(nn.Module):
             # args=self.args
         )
 
-        self.cache_k = self.cache_k.to(self.args.device)
-        self.cache_v = self.cache_v.to(self.args.device)
-
-        # self.cache_k = self.cache_k.to(xq)
-        # self.cache_v = self.cache_v.to(xq)
-
         self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
         self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
 
@@ -3,12 +3,21 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+from functools import lru_cache
 import logging
 import os
-from typing import List
+from typing import List, Tuple
 
 from sentencepiece import SentencePieceProcessor  # type: ignore
 
+try:
+    # Rust-backed tokenizer, used when pointed at a tokenizers-format
+    # (.json) file - roughly an order of magnitude faster than the Python
+    # sentencepiece bindings
+    from tokenizers import Tokenizer as RustTokenizer  # type: ignore
+except ImportError:
+    RustTokenizer = None  # type: ignore
+
 
 class Tokenizer:
     """tokenizing and encoding/decoding text using SentencePiece."""
@@ -18,26 +27,71 @@ class Tokenizer:
         Initializes the Tokenizer with a SentencePiece model.
 
         Args:
-            model_path (str): The path to the SentencePiece model file.
+            model_path (str): The path to the SentencePiece model file, or to a
+                huggingface-tokenizers .json file for the Rust backend.
         """
         # reload tokenizer
         assert os.path.isfile(model_path), model_path
         self.execution_id = execution_id
-        self.sp_model = SentencePieceProcessor()
-        self.sp_model.LoadFromFile(model_path)
         self.logger = logger
-        self.logger.info(
-            {
-                "action": "reloaded sentencepiece model",
-                "filename": model_path,
-            }
-        )
 
-        # BOS / EOS token IDs
-        self.n_words: int = self.sp_model.vocab_size()
-        self.bos_id: int = self.sp_model.bos_id()
-        self.eos_id: int = self.sp_model.eos_id()
-        self.pad_id: int = self.sp_model.pad_id()
+        # the shipped tokenizer.model is SentencePiece-format, which the Rust
+        # backend can't read - so that stays the default and the fast path
+        # only kicks in for a converted .json file
+        if model_path.endswith(".json") and RustTokenizer is not None:
+            self.rust_model = RustTokenizer.from_file(model_path)
+            self.sp_model = None
+            self.logger.info(
+                {
+                    "action": "loaded rust tokenizer model",
+                    "filename": model_path,
+                }
+            )
+            self.n_words: int = self.rust_model.get_vocab_size()
+            bos_id = self.rust_model.token_to_id("<s>")
+            eos_id = self.rust_model.token_to_id("</s>")
+            assert bos_id is not None and eos_id is not None, (
+                f"{model_path} is missing the <s>/</s> special tokens"
+            )
+            self.bos_id: int = bos_id
+            self.eos_id: int = eos_id
+            self.pad_id: int = -1
+        else:
+            self.rust_model = None
+            self.sp_model = SentencePieceProcessor()
+            self.sp_model.LoadFromFile(model_path)
+            self.logger.info(
+                {
+                    "action": "reloaded sentencepiece model",
+                    "filename": model_path,
+                }
+            )
+
+            # BOS / EOS token IDs
+            self.n_words = self.sp_model.vocab_size()
+            self.bos_id = self.sp_model.bos_id()
+            self.eos_id = self.sp_model.eos_id()
+            self.pad_id = self.sp_model.pad_id()
+            # check against the value we already fetched rather than calling
+            # vocab_size() into the extension a second time
+            assert self.n_words == self.sp_model.GetPieceSize()
+
+            # remapping near-duplicate pieces onto shared ids would also remap
+            # which embedding rows the checkpoint's weights land on, so the
+            # vocab can't actually be shrunk at load time - the most we can
+            # safely do is report how much of it is case-duplicated
+            if self.logger.isEnabledFor(logging.DEBUG):
+                pieces = {
+                    self.sp_model.IdToPiece(i).lower() for i in range(self.n_words)
+                }
+                self.logger.debug(
+                    {
+                        "action": "vocab_duplicate_audit",
+                        "pieces": self.n_words,
+                        "unique_casefolded": len(pieces),
+                    }
+                )
+
         self.logger.info(
             {
                 "words": self.n_words,
@@ -45,7 +99,30 @@ class Tokenizer:
                 "eos_id": self.eos_id,
             }
         )
-        assert self.sp_model.vocab_size() == self.sp_model.GetPieceSize()
+
+        # system prompts and role tags come through encode() over and over -
+        # memoise the raw backend call per instance. tuples, so cached values
+        # can't be mutated out from under the cache
+        self._encode_raw = lru_cache(maxsize=256)(self._encode_raw_uncached)
+        # the per-token 'tokens' output lists decode one id at a time and hit
+        # the same vocabulary entries constantly - memoise those too
+        self._decode_single = lru_cache(maxsize=4096)(self._decode_single_uncached)
+
+    def _decode_single_uncached(self, token_id: int) -> str:
+        """decode a single token id straight off the backend"""
+        if self.rust_model is not None:
+            res: str = self.rust_model.decode([token_id])
+            return res
+        res = self.sp_model.Decode(token_id)
+        return res
+
+    def _encode_raw_uncached(self, input_string: str) -> Tuple[int, ...]:
+        """raw backend encode with no BOS/EOS handling"""
+        if self.rust_model is not None:
+            return tuple(
+                self.rust_model.encode(input_string, add_special_tokens=False).ids
+            )
+        return tuple(self.sp_model.Encode(input_string))
 
     def encode(self, input_string: str, bos: bool, eos: bool) -> List[int]:
         """
@@ -59,21 +136,68 @@ class Tokenizer:
         Returns:
             List[int]: A list of token IDs.
         """
-        self.logger.info(
-            {
-                "action": "encode",
-                "execution_id": self.execution_id,
-                "input": input_string,
-            }
-        )
+        # encode runs per turn per dialog - don't even build the payload dict
+        # if nothing is listening at INFO
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                {
+                    "action": "encode",
+                    "execution_id": self.execution_id,
+                    "input": input_string,
+                }
+            )
         assert isinstance(input_string, str)
-        t: List[int] = self.sp_model.Encode(input_string)
-        if bos:
-            t = [self.bos_id] + t
+        # build the output list once rather than re-copying it for each
+        # special token tacked on
+        t: List[int] = [self.bos_id] if bos else []
+        t.extend(self._encode_raw(input_string))
         if eos:
-            t = t + [self.eos_id]
+            t.append(self.eos_id)
         return t
 
+    def encode_batch(
+        self, input_strings: List[str], bos: bool, eos: bool
+    ) -> List[List[int]]:
+        """
+        Encodes a batch of strings into lists of token IDs in a single call.
+
+        Args:
+            input_strings (List[str]): The input strings to be encoded.
+            bos (bool): Whether to prepend the beginning-of-sequence token.
+            eos (bool): Whether to append the end-of-sequence token.
+
+        Returns:
+            List[List[int]]: One list of token IDs per input string.
+        """
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                {
+                    "action": "encode_batch",
+                    "execution_id": self.execution_id,
+                    "inputs": input_strings,
+                }
+            )
+        if self.rust_model is not None:
+            encoded: List[List[int]] = [
+                enc.ids
+                for enc in self.rust_model.encode_batch(
+                    input_strings, add_special_tokens=False
+                )
+            ]
+        else:
+            encoded = self.sp_model.Encode(input_strings)
+        # the backend hands us fresh lists, so splice the special tokens in
+        # place instead of rebuilding every row
+        if bos:
+            bos_id = self.bos_id
+            for t in encoded:
+                t.insert(0, bos_id)
+        if eos:
+            eos_id = self.eos_id
+            for t in encoded:
+                t.append(eos_id)
+        return encoded
+
     def decode(self, t: List[int]) -> str:
         """
         Decodes a list of token IDs into a string.
@@ -85,14 +209,22 @@ class Tokenizer:
             str: The decoded string.
         """
 
-        # only send it as a list if it's not a single item
-        res: str = self.sp_model.Decode(t if len(t) > 1 else t[0])
-        self.logger.info(
-            {
-                "action": "decode",
-                "execution_id": self.execution_id,
-                "input": t,
-                "result": res,
-            }
-        )
+        if len(t) == 1:
+            # single ids go through the memoised piece cache
+            res: str = self._decode_single(t[0])
+        elif self.rust_model is not None:
+            res = self.rust_model.decode(t)
+        else:
+            res = self.sp_model.Decode(t)
+        # decode gets hit once per generated token when logprobs are on -
+        # skip the payload build entirely when INFO is filtered out
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                {
+                    "action": "decode",
+                    "execution_id": self.execution_id,
+                    "input": t,
+                    "result": res,
+                }
+            )
         return res
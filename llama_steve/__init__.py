@@ -1,44 +1,136 @@
 """ where we hide things """
+import atexit
 from datetime import datetime
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+from queue import SimpleQueue
 
 from typing import Any, Dict
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    # fall back to stdlib json if orjson isn't around
+    orjson = None  # type: ignore
+
+
+def _record_to_dict(record: logging.LogRecord) -> Dict[str, Any]:
+    """coerce a record's payload into a dict ready for serialisation"""
+    msg = record.msg
+
+    if isinstance(msg, dict):
+        # shallow-copy so injecting level/_time below doesn't mutate the
+        # caller's dict - it may still be live (and, with the queue listener,
+        # we're annotating it from another thread)
+        res: Dict[str, Any] = {**msg}
+    else:
+        if isinstance(msg, str):
+            try:
+                res = json.loads(msg)
+            except json.JSONDecodeError as error:
+                print(f"Welp, failed to JSON decode {msg}: {error}")
+                res = {"message": msg}
+        elif isinstance(msg, list):
+            res = {"messages": msg}
+        else:
+            res = {"message": msg}
+
+    res["level"] = record.levelname
+    return res
+
 
 class JSONFormatter(logging.Formatter):
     """formats things for logging purposes"""
 
+    def __init__(self) -> None:
+        super().__init__()
+        # consecutive records usually land within the same second, so cache
+        # the expensive datetime/isoformat work at one-second granularity
+        self._last_secs = -1
+        self._last_time = ""
+
+    def format_time(self, created: float) -> str:
+        """isoformat timestamp for a record's creation time, mostly cached"""
+        secs = int(created)
+        if secs != self._last_secs:
+            self._last_time = datetime.utcfromtimestamp(secs).isoformat()
+            self._last_secs = secs
+        return f"{self._last_time}.{int((created - secs) * 1_000_000):06d}"
+
     def format(self, record: logging.LogRecord) -> str:
         """format the message"""
-        msg = record.msg
+        res = _record_to_dict(record)
+        res["_time"] = self.format_time(record.created)
+        if orjson is not None:
+            return orjson.dumps(
+                res, default=str, option=orjson.OPT_SORT_KEYS
+            ).decode("utf-8")
+        return json.dumps(res, default=str, sort_keys=True, ensure_ascii=False)
 
-        if isinstance(msg, dict):
-            res: Dict[str, Any] = msg
-        else:
-            if isinstance(msg, str):
-                try:
-                    res = json.loads(msg)
-                except json.JSONDecodeError as error:
-                    print(f"Welp, failed to JSON decode {msg}: {error}")
-                    res = {"message": msg}
-            elif isinstance(msg, list):
-                res = {"messages": msg}
+
+class NDJSONHandler(logging.Handler):
+    """writes records to a file as NDJSON bytes, skipping the Formatter detour"""
+
+    def __init__(self, filename: str) -> None:
+        super().__init__()
+        # binary append, one write per record so lines stay whole
+        # pylint: disable=consider-using-with
+        self.stream = open(filename, "ab")
+        # borrow the formatter's cached timestamp rendering without routing
+        # records through logging.Formatter's string machinery
+        self._format_time = JSONFormatter().format_time
+
+    def emit(self, record: logging.LogRecord) -> None:
+        """serialise the record straight to bytes and write it"""
+        try:
+            res = _record_to_dict(record)
+            res["_time"] = self._format_time(record.created)
+            if orjson is not None:
+                line = orjson.dumps(res, default=str, option=orjson.OPT_SORT_KEYS)
             else:
-                res = {"message": msg}
+                line = json.dumps(
+                    res, default=str, sort_keys=True, ensure_ascii=False
+                ).encode("utf-8")
+            self.stream.write(line + b"\n")
+            self.stream.flush()
+        # pylint: disable=broad-except
+        except Exception:
+            self.handleError(record)
 
-        res["level"] = record.levelname
-        res["_time"] = datetime.utcnow().isoformat()
-        return json.dumps(res, default=str, sort_keys=True, ensure_ascii=False)
+    def close(self) -> None:
+        """flush and close the underlying file"""
+        try:
+            self.stream.close()
+        finally:
+            super().close()
+
+
+class DictQueueHandler(QueueHandler):
+    """queue handler that leaves dict payloads alone"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """the stock prepare() flattens record.msg to a string, which would
+        break JSONFormatter's dict handling - everything stays in-process
+        here, so ship the record through untouched"""
+        return record
 
 
 def setup_logging() -> logging.Logger:
     """sets up logging"""
     logger = logging.getLogger("llama")
-    handler = logging.FileHandler("llama_steve.json")
-    handler.setFormatter(JSONFormatter())
-    logger.addHandler(handler)
+    # serialise straight to NDJSON bytes, no Formatter string round-trip
+    file_handler = NDJSONHandler("llama_steve.json")
+
+    # push records through a queue so serialisation and file writes happen on
+    # a background thread instead of blocking the chat loop
+    queue: "SimpleQueue[logging.LogRecord]" = SimpleQueue()
+    listener = QueueListener(queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(DictQueueHandler(queue))
     # logger.addHandler(logging.StreamHandler(sys.stdout))
     logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
     return logger
@@ -1,13 +1,30 @@
 """ cli for talking to llama-powered steve """
 import json
 import logging
+import os
 from pathlib import Path
 from random import randint
 from typing import List, Literal, Optional, TypedDict, Union
-from uuid import uuid4
 import click
 import questionary
 import torch.cuda
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    # fall back to stdlib json if orjson isn't around
+    orjson = None  # type: ignore
+
+try:
+    import fastjsonschema  # type: ignore
+except ImportError:
+    # fall back to a plain required-keys check if it isn't around
+    fastjsonschema = None  # type: ignore
+
+try:
+    import msgspec  # type: ignore
+except ImportError:
+    msgspec = None  # type: ignore
 from llama.generation import ChatPrediction, Dialog, DialogOrderError, Llama, Message
 from llama.generation import PromptTooLongError
 
@@ -25,15 +42,55 @@ class Config(TypedDict):
     tokenizer_path: str
 
 
+# what the config file has to look like for Steve to start at all -
+# compiled once at import time so validation is a single call
+CONFIG_SCHEMA = {
+    "type": "object",
+    "required": [
+        "max_batch_size",
+        "nproc_per_node",
+        "model_dir",
+        "temperature",
+        "max_seq_len",
+        "tokenizer_path",
+    ],
+}
+
+_validate_config = (
+    fastjsonschema.compile(CONFIG_SCHEMA) if fastjsonschema is not None else None
+)
+
+
 def load_config(filepath: Path) -> Config:
     """load from a path"""
-    with filepath.open("r", encoding="utf-8") as fh:
-        res: Config = json.load(fh)
+    # read the raw bytes once - a text-mode handle decodes the whole file to
+    # str before the parser gets anywhere near it
+    raw = filepath.read_bytes()
+    if msgspec is not None:
+        # typed decode straight into the Config TypedDict - parses, checks
+        # the keys and types in one native pass, and still hands back the
+        # plain dict the rest of the code indexes into
+        res: Config = msgspec.json.decode(raw, type=Config)
+        return res
+    if orjson is not None:
+        res = orjson.loads(raw)
+    else:
+        res = json.loads(raw)
+    # catch a broken config here rather than as a KeyError mid-model-load
+    if _validate_config is not None:
+        _validate_config(res)
+    else:
+        for key in CONFIG_SCHEMA["required"]:
+            if key not in res:
+                raise KeyError(f"config file {filepath} is missing key: {key}")
     return res
 
 
 def save_config(config: Config, filepath: Path) -> None:
     """save to a path"""
+    if orjson is not None:
+        filepath.write_bytes(orjson.dumps(config))
+        return
     with filepath.open("w", encoding="utf-8") as fh:
         json.dump(config, fh)
 
@@ -48,8 +105,17 @@ class Steve:
         self.logger = logger
         self.config = config
         self.user_name = user_name.strip()
+        # the prefix strings never change over a session - build them once
+        # here instead of per message
+        self.prefixes = {
+            "assistant": "Steve: ",
+            "user": f"{self.user_name}: ",
+            "error": "ERROR: ",
+        }
         self.message_history: Dialog = []
-        self.session_id = uuid4().hex
+        # same shape as uuid4().hex (32 hex chars) without the UUID object
+        # construction and field shuffling on the way through
+        self.session_id = os.urandom(16).hex()
         self.llama = Llama.build(
             ckpt_dir=config["model_dir"],
             tokenizer_path=config["tokenizer_path"],
@@ -67,14 +133,8 @@ class Steve:
     ) -> None:
         """shows a message to the user"""
 
-        if role == "assistant":
-            prefix = "Steve: "
-        elif role == "user":
-            prefix = f"{self.user_name}: "
-        elif role == "error":
-            prefix = "ERROR: "
-        else:
-            prefix = f"{role}: "
+        # dict dispatch instead of walking a branch ladder per message
+        prefix = self.prefixes.get(role, f"{role}: ")
         if isinstance(message, dict):
             role = message.get("role", role)
             message = message.get("content", "").strip()